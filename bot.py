@@ -1,16 +1,36 @@
 import asyncio
 import os
 import logging
+import random
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from dataclasses import dataclass
 from io import BytesIO
+from time import monotonic
+import onnxruntime as ort
 from PIL import Image
-from rembg import remove
+from rembg import new_session, remove
+from aiohttp import web
+
+try:
+    import uvloop  # libuv-based event loop, not available on Windows
+except ImportError:
+    uvloop = None
 
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.types import BufferedInputFile, InputSticker
 from aiogram.filters import CommandStart
-from aiogram.exceptions import TelegramNotFound, TelegramBadRequest
+from aiogram.exceptions import (
+    TelegramNotFound, TelegramBadRequest, TelegramRetryAfter, TelegramNetworkError, TelegramServerError,
+)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,12 +43,39 @@ TOKEN = os.environ.get("BOT_TOKEN")
 OWNER_ID = int(os.environ.get("OWNER_USER_ID", 0)) 
 PACK_PREFIX = os.environ.get("STICKER_PACK_PREFIX", "funstickers")
 
+# Webhook settings (webhook mode is used when WEBHOOK_URL is set, otherwise long-polling)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # Public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or None
+WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.environ.get("WEBAPP_PORT", 8080))
+
+# FSM storage: Redis lets several bot processes share conversation state
+REDIS_URL = os.environ.get("REDIS_URL")
+
 # Global variables to cache bot info and pack name after initialization
 BOT_USERNAME = None
 PACK_NAME = None
+PACK_LINK = None
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
+# Cached result of the pack existence probe (None = not checked yet)
+_pack_exists_cache: bool | None = None
+
+def build_session(limit_per_host: int) -> AiohttpSession:
+    """Create an aiohttp session with a larger, keep-alive connection pool."""
+    session = AiohttpSession(limit=256)
+    session._connector_init.update(
+        limit_per_host=limit_per_host,
+        keepalive_timeout=75,
+        ttl_dns_cache=300,
+    )
+    return session
+
+# 'bot' serves all short API calls; long-polling getUpdates runs on its own
+# small pool so it can never starve sends, edits and uploads of connections.
+bot = Bot(token=TOKEN, session=build_session(limit_per_host=64))
+polling_bot = Bot(token=TOKEN, session=build_session(limit_per_host=4))
+dp = Dispatcher(storage=RedisStorage.from_url(REDIS_URL) if REDIS_URL else MemoryStorage())
 
 # -------------------------
 # FSM States
@@ -37,13 +84,144 @@ class StickerCreation(StatesGroup):
     """States for the multi-step sticker creation process."""
     waiting_for_mode_selection = State()
 
+# -------------------------
+# Rate Limiting
+# -------------------------
+
+class AsyncTokenBucket:
+    """
+    Async token bucket: refills `rate` tokens per second, holding at most `burst`.
+    Use as `async with limiter:` to take one token, waiting until one is available.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = monotonic()
+        self._cond = asyncio.Condition()
+        self._waiters = 0
+        self._refill_task = None
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def _refill_loop(self):
+        # Ticks only while callers are waiting; each tick wakes them to re-check
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            async with self._cond:
+                self._refill()
+                self._cond.notify_all()
+                if not self._waiters:
+                    self._refill_task = None
+                    return
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return not self._waiters and self.tokens >= self.burst
+
+    async def __aenter__(self):
+        async with self._cond:
+            self._refill()
+            if self.tokens < 1:
+                self._waiters += 1
+                if self._refill_task is None:
+                    self._refill_task = asyncio.create_task(self._refill_loop())
+                try:
+                    await self._cond.wait_for(lambda: self.tokens >= 1)
+                finally:
+                    self._waiters -= 1
+            self.tokens -= 1
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+# Telegram allows ~30 requests/s overall and ~1 message/s per chat (short bursts are fine)
+GLOBAL_LIMITER = AsyncTokenBucket(rate=25, burst=25)
+CHAT_RATE, CHAT_BURST = 1, 3
+MAX_CHAT_LIMITERS = 1024
+_chat_limiters: dict[int, AsyncTokenBucket] = {}
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+def chat_limiter(chat_id: int) -> AsyncTokenBucket:
+    """Return the per-chat limiter, dropping idle ones once the table grows large."""
+    limiter = _chat_limiters.get(chat_id)
+    if limiter is None:
+        if len(_chat_limiters) >= MAX_CHAT_LIMITERS:
+            for key in [k for k, v in _chat_limiters.items() if v.idle]:
+                del _chat_limiters[key]
+        limiter = _chat_limiters[chat_id] = AsyncTokenBucket(CHAT_RATE, CHAT_BURST)
+    return limiter
+
+async def call_limited(make_call, chat_id: int | None = None):
+    """
+    Run a Telegram API call under the global (and optional per-chat) rate limit.
+    `make_call` is a zero-argument callable returning a fresh coroutine, so the
+    call can be retried after Telegram answers with 'Too Many Requests'.
+    """
+    for attempt in range(MAX_RETRY_AFTER_ATTEMPTS + 1):
+        try:
+            limiter = chat_limiter(chat_id) if chat_id is not None else nullcontext()
+            async with limiter, GLOBAL_LIMITER:
+                return await make_call()
+        except TelegramRetryAfter as e:
+            if attempt == MAX_RETRY_AFTER_ATTEMPTS:
+                raise
+            logger.warning(f"Flood control hit, retrying in {e.retry_after}s (attempt {attempt + 1}).")
+            await asyncio.sleep(e.retry_after)
+
+async def send_text(chat_id: int, text: str, **kwargs):
+    """Rate-limited bot.send_message."""
+    return await call_limited(lambda: bot.send_message(chat_id, text, **kwargs), chat_id)
+
+async def edit_text(chat_id: int, **kwargs):
+    """Rate-limited bot.edit_message_text."""
+    return await call_limited(lambda: bot.edit_message_text(chat_id=chat_id, **kwargs), chat_id)
+
 # -------------------------
 # Helper Functions
 # -------------------------
 
-def resize_to_sticker(photo_bytes: bytes, mode: str) -> BytesIO:
+# rembg session, created once per worker process by _init_rembg()
+_REMBG_SESSION = None
+
+# ONNX Runtime execution providers in order of preference (unavailable ones are skipped)
+REMBG_PROVIDERS = ["CUDAExecutionProvider", "CoreMLExecutionProvider", "CPUExecutionProvider"]
+# Providers this onnxruntime build offers, in that order
+REMBG_SESSION_PROVIDERS = [p for p in REMBG_PROVIDERS if p in ort.get_available_providers()]
+
+def _probe_cuda() -> bool:
+    """
+    Runs in a throwaway process: build a small CUDA session and report whether it
+    really bound to the GPU. The provider list above only says how onnxruntime was
+    built, and ORT silently falls back to CPU on hosts without a usable device.
+    """
+    session = new_session("u2netp", providers=["CUDAExecutionProvider", "CPUExecutionProvider"])
+    return "CUDAExecutionProvider" in session.inner_session.get_providers()
+
+def _init_rembg(model: str, threads: int, expect_cuda: bool):
+    """Process pool initializer: load the rembg model once per worker."""
+    global _REMBG_SESSION
+    # Split the cores between the pool's workers instead of letting every ONNX
+    # session start one thread per core (rembg applies this as intra/inter-op threads).
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+    _REMBG_SESSION = new_session(model, providers=REMBG_SESSION_PROVIDERS)
+    providers = _REMBG_SESSION.inner_session.get_providers()
+    logger.info(f"rembg model '{model}' loaded with providers {providers}")
+    if expect_cuda and "CUDAExecutionProvider" not in providers:
+        logger.warning(f"rembg model '{model}' was expected on CUDA but is running on {providers}.")
+
+def _warm_worker() -> int:
+    """No-op task; scheduling it forces a worker (and its rembg session) to start."""
+    return os.getpid()
+
+def _resize_worker(photo_bytes: bytes, mode: str) -> bytes:
     """
     Removes background using 'rembg', then resizes the image based on the chosen mode.
+    Runs inside a PPE worker process and returns the encoded WebP as raw bytes.
     
     Modes:
     - 'fit': Resizes to max 512x512 while preserving aspect ratio (no distortion).
@@ -51,11 +229,14 @@ def resize_to_sticker(photo_bytes: bytes, mode: str) -> BytesIO:
     """
     TARGET_SIZE = 512
     try:
+        img = Image.open(BytesIO(photo_bytes))
+        # For JPEGs (all Telegram photos), decode straight at the smallest 1/2, 1/4
+        # or 1/8 scale that still covers 512x512, instead of the full raster.
+        img.draft('RGB', (TARGET_SIZE, TARGET_SIZE))
+
         # --- Background Removal Step ---
-        output_png_bytes = remove(photo_bytes) 
-        
-        # Open the processed PNG image using PIL
-        img = Image.open(BytesIO(output_png_bytes))
+        # Passing a PIL image skips rembg's internal PNG encode/decode.
+        img = remove(img, session=_REMBG_SESSION, post_process_mask=True)
         
         # Ensure it has an alpha channel (RGBA) for transparency
         if img.mode != 'RGBA':
@@ -79,35 +260,178 @@ def resize_to_sticker(photo_bytes: bytes, mode: str) -> BytesIO:
                 bottom = (height + width) // 2
                 img = img.crop((left, top, right, bottom))
             # Now the image is square, so we can just resize to 512x512
-            img = img.resize((TARGET_SIZE, TARGET_SIZE), Image.Resampling.LANCZOS)
+            # (reducing_gap box-reduces first, then LANCZOS on the small image)
+            img = img.resize((TARGET_SIZE, TARGET_SIZE), Image.Resampling.LANCZOS, reducing_gap=3.0)
             
         elif mode == 'fit':
             # --- Fit (Preserve Aspect Ratio) ---
             # This maintains aspect ratio and prevents distortion, ensuring max size is 512x512
             img.thumbnail((TARGET_SIZE, TARGET_SIZE), Image.Resampling.LANCZOS)
         
-        # Save the final resized PNG file into a BytesIO object
+        # Save the final sticker as WebP (accepted natively by Telegram and several
+        # times smaller than PNG) and hand back plain bytes (cheap to pickle).
+        # method=4 rather than 6: several times faster to encode for only a few % larger output.
         output = BytesIO()
-        img.save(output, format="PNG")
-        output.name = "sticker.png"
-        output.seek(0)
-        return output
+        img.save(output, format="WEBP", quality=90, method=4)
+        return output.getvalue()
     except Exception as e:
         logger.error(f"Image processing (rembg/resize) failed: {e}")
         raise ValueError(f"Image processing failed: {e}")
 
+# CPU-bound image work runs in worker processes so the event loop stays free
+# to handle other users' updates while a sticker is being prepared.
+# On a GPU every worker would hold its own CUDA context and copy of u2net, while
+# the GPU runs the jobs one at a time anyway; keep that pool small.
+REMBG_GPU_WORKERS = int(os.environ.get("REMBG_GPU_WORKERS", 1))
+
+# Set by start_pool() once it knows whether a GPU is really usable
+REMBG_MODEL = "u2netp"
+REMBG_ON_GPU = False
+PPE_WORKERS = os.cpu_count() or 1
+PPE: ProcessPoolExecutor | None = None
+_pool_lock = asyncio.Lock()
+
+def create_pool() -> ProcessPoolExecutor:
+    threads = max(1, (os.cpu_count() or 1) // PPE_WORKERS)
+    return ProcessPoolExecutor(
+        max_workers=PPE_WORKERS,
+        initializer=_init_rembg,
+        initargs=(REMBG_MODEL, threads, REMBG_ON_GPU),
+    )
+
+async def warm_up_workers():
+    """Start every pool worker up front so the first photos don't pay the model load."""
+    loop = asyncio.get_running_loop()
+    pids = await asyncio.gather(*(loop.run_in_executor(PPE, _warm_worker) for _ in range(PPE_WORKERS)))
+    logger.info(f"rembg loaded in {len(set(pids))} worker process(es).")
+
+async def start_pool():
+    """
+    Pick the model and pool size from what a real session binds to: full U2Net
+    on a working CUDA GPU with a small pool, otherwise u2netp with one worker per core.
+    """
+    global REMBG_MODEL, REMBG_ON_GPU, PPE_WORKERS, PPE
+    if "CUDAExecutionProvider" in REMBG_SESSION_PROVIDERS:
+        # Probe in a separate process so this one never creates a CUDA context
+        # that the forked pool workers would inherit.
+        with ProcessPoolExecutor(max_workers=1) as probe:
+            try:
+                REMBG_ON_GPU = await asyncio.get_running_loop().run_in_executor(probe, _probe_cuda)
+            except Exception as e:
+                logger.warning(f"CUDA probe failed, using CPU: {e}")
+        if not REMBG_ON_GPU:
+            logger.warning("onnxruntime has CUDA support but no usable GPU was found; using CPU.")
+    if REMBG_ON_GPU:
+        REMBG_MODEL, PPE_WORKERS = "u2net", REMBG_GPU_WORKERS
+    PPE = create_pool()
+    await warm_up_workers()
+
+async def rebuild_pool(broken: ProcessPoolExecutor):
+    """
+    Replace a pool that lost a worker (OOM kill, native crash). A broken pool
+    rejects every later submit, so without this all following stickers would fail.
+    """
+    global PPE
+    async with _pool_lock:
+        if PPE is not broken:
+            return # Another task already rebuilt it
+        logger.error("Image worker pool is broken, restarting it.")
+        broken.shutdown(wait=False, cancel_futures=True)
+        PPE = create_pool()
+        try:
+            await warm_up_workers()
+        except BrokenProcessPool as e:
+            # Leave it to the next sticker to try again
+            logger.error(f"Restarted image worker pool failed to start: {e}")
+
+# Photos prefetched while the user picks a scaling mode: blob key -> (expiry, download task).
+# Only the key lives in FSM state; other workers (or expired keys) fall back to the file_id.
+PHOTO_BLOB_TTL = 600
+MAX_BLOBS = 256
+BLOBS: dict[str, tuple[float, asyncio.Task]] = {}
+
+async def _download_photo(file_id: str) -> bytes | None:
+    try:
+        file_data = await call_limited(lambda: bot.download(file_id, destination=BytesIO()))
+        return file_data.getvalue()
+    except Exception as e:
+        logger.warning(f"Photo prefetch failed for {file_id}: {e}")
+        return None
+
+def drop_photo(key: str | None):
+    """Forget a prefetched photo, cancelling its download if it is still running."""
+    _, task = BLOBS.pop(key, (None, None))
+    if task:
+        task.cancel()
+
+def prefetch_photo(key: str, file_id: str):
+    """Start downloading the photo in the background and keep it for PHOTO_BLOB_TTL seconds."""
+    # Entries are inserted in expiry order, so once full the first one is the oldest
+    while len(BLOBS) >= MAX_BLOBS:
+        drop_photo(next(iter(BLOBS)))
+    BLOBS[key] = (monotonic() + PHOTO_BLOB_TTL, asyncio.create_task(_download_photo(file_id)))
+
+async def take_photo(key: str | None, file_id: str) -> bytes:
+    """Return the prefetched photo for `key`, downloading it by file_id if it isn't here."""
+    _, task = BLOBS.pop(key, (None, None))
+    photo_bytes = await task if task else None
+    if photo_bytes is None:
+        file_data = await call_limited(lambda: bot.download(file_id, destination=BytesIO()))
+        photo_bytes = file_data.getvalue()
+    return photo_bytes
+
+async def expire_blobs(interval: float = 60):
+    """Periodically drop prefetched photos nobody picked a mode for."""
+    while True:
+        await asyncio.sleep(interval)
+        now = monotonic()
+        for key in [k for k, (expires, _) in BLOBS.items() if expires <= now]:
+            drop_photo(key)
+
+def pick_photo_size(sizes: list[types.PhotoSize]) -> types.PhotoSize:
+    """
+    Telegram offers each photo in several sizes (sorted smallest first). Stickers
+    are at most 512x512, so a bigger original only adds download time and memory.
+    """
+    for size in sizes:
+        if min(size.width, size.height) >= 512:
+            return size
+    return sizes[-1]
+
+async def get_me_with_retry(attempts: int = 5, base: float = 1.0, cap: float = 30.0, timeout: float = 10.0):
+    """
+    Call getMe, retrying transient failures with capped exponential backoff and
+    full jitter. Each attempt is bounded by `timeout` so a stuck connection
+    cannot stall startup on top of the backoff sleeps.
+    """
+    for attempt in range(attempts):
+        try:
+            return await asyncio.wait_for(bot.get_me(), timeout=timeout)
+        except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+            if attempt == attempts - 1:
+                raise
+            delay = min(cap, base * 2 ** attempt) * random.random()
+            logger.warning(f"getMe failed ({e!r}), retrying in {delay:.1f}s (attempt {attempt + 1}/{attempts}).")
+            await asyncio.sleep(delay)
+
 async def init_bot_info():
     """Retrieve bot username and calculate the sticker pack name once."""
-    global BOT_USERNAME, PACK_NAME
-    info = await bot.get_me()
+    global BOT_USERNAME, PACK_NAME, PACK_LINK
+    info = await get_me_with_retry()
     BOT_USERNAME = info.username.lower()
     PACK_NAME = f"{PACK_PREFIX}_by_{BOT_USERNAME}"
+    PACK_LINK = f"https://t.me/addstickers/{PACK_NAME}"
     logger.info(f"Bot initialized. Sticker Pack Name: {PACK_NAME}")
 
 async def pack_exists(pack_name: str) -> bool:
-    """Check if the sticker pack exists, catching the specific 'not found' exception."""
+    """Check if the sticker pack exists, catching the specific 'not found' exception.
+    A positive answer is cached so the hot path skips the extra API round-trip."""
+    global _pack_exists_cache
+    if _pack_exists_cache is not None:
+        return _pack_exists_cache
     try:
-        await bot.get_sticker_set(pack_name)
+        await call_limited(lambda: bot.get_sticker_set(pack_name))
+        _pack_exists_cache = True
         return True
     except TelegramNotFound:
         return False
@@ -115,68 +439,166 @@ async def pack_exists(pack_name: str) -> bool:
         logger.error(f"Error checking pack existence for {pack_name}: {e}")
         return False
 
-async def create_pack(pack_name: str, png_file: BytesIO):
+async def create_pack(pack_name: str, sticker: InputSticker):
     """Attempt to create the sticker pack."""
+    global _pack_exists_cache
     try:
-        await bot.create_new_sticker_set(
+        await call_limited(lambda: bot.create_new_sticker_set(
             user_id=OWNER_ID,
             name=pack_name,
             title="Shared Sticker Pack (by Bot)",
-            png_sticker=png_file,
-            emojis="⭐",
-        )
+            stickers=[sticker],
+        ))
+        _pack_exists_cache = True
         logger.info(f"Sticker pack '{pack_name}' created successfully.")
     except Exception as e:
         logger.error(f"Failed to create sticker pack: {e}")
         raise
 
-async def add_to_pack(pack_name: str, png_file: BytesIO):
-    """Attempt to add a sticker to the existing pack."""
+async def add_to_pack(pack_name: str, sticker: InputSticker):
+    """Attempt to add a sticker to the existing pack.
+    If the cached 'pack exists' answer turns out stale, the pack is recreated."""
+    global _pack_exists_cache
     try:
-        await bot.add_sticker_to_set(
+        await call_limited(lambda: bot.add_sticker_to_set(
             user_id=OWNER_ID,
             name=pack_name,
-            png_sticker=png_file,
-            emojis="⭐"
-        )
+            sticker=sticker,
+        ))
         logger.info(f"Sticker added to pack '{pack_name}'.")
+    except (TelegramNotFound, TelegramBadRequest) as e:
+        # Telegram reports a deleted set as 400 STICKERSET_INVALID
+        if isinstance(e, TelegramBadRequest) and "STICKERSET_INVALID" not in e.message:
+            logger.error(f"Failed to add sticker to pack: {e}")
+            raise
+        logger.warning(f"Sticker pack '{pack_name}' not found, recreating it.")
+        _pack_exists_cache = None
+        await create_pack(pack_name, sticker)
     except Exception as e:
         logger.error(f"Failed to add sticker to pack: {e}")
         raise
 
+# -------------------------
+# Sticker Pipeline
+# -------------------------
+# Chosen stickers flow through two stages joined by bounded queues, so a slow
+# Telegram upload never holds up image processing for the next photos:
+#   process_q -> process_worker (x PPE_WORKERS): get photo, rembg + resize in the pool
+#   upload_q  -> upload_worker (x1): create the pack or add to it
+# Results are reported by separate notify() tasks so chat limits never block a stage.
+# A single upload worker also keeps two stickers from racing to create the pack.
+# Full queues make the handlers wait, which bounds memory under bursts.
+
+@dataclass
+class StickerJob:
+    """One sticker request moving through the pipeline."""
+    chat_id: int
+    wait_message_id: int
+    blob_key: str | None
+    file_id: str
+    mode: str
+    webp: bytes | None = None
+
+PIPELINE_QUEUE_SIZE = 32
+process_q: asyncio.Queue[StickerJob] = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+upload_q: asyncio.Queue[StickerJob] = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+async def finish_job(job: StickerJob, text: str):
+    """Report the job's outcome by editing its wait message."""
+    try:
+        await edit_text(job.chat_id, message_id=job.wait_message_id, text=text)
+    except Exception as e:
+        logger.error(f"Failed to report sticker result to chat {job.chat_id}: {e}")
+
+# Result messages still being sent (kept referenced until done)
+_notify_tasks: set[asyncio.Task] = set()
+
+def notify(job: StickerJob, text: str):
+    """Report the job's outcome in the background."""
+    task = asyncio.create_task(finish_job(job, text))
+    _notify_tasks.add(task)
+    task.add_done_callback(_notify_tasks.discard)
+
+async def process_worker():
+    """Stage 1: fetch the photo and run the heavy rembg/PIL work in the process pool."""
+    loop = asyncio.get_running_loop()
+    while True:
+        job = await process_q.get()
+        pool = PPE
+        try:
+            # Use the photo prefetched in step 1 (or download it now)
+            photo_bytes = await take_photo(job.blob_key, job.file_id)
+            job.webp = await loop.run_in_executor(pool, _resize_worker, photo_bytes, job.mode)
+            await upload_q.put(job)
+        except BrokenProcessPool:
+            notify(job, "❌ Sticker creation failed during processing. Details: the image worker crashed, please send the photo again.")
+            await rebuild_pool(pool)
+        except ValueError as e:
+            notify(job, f"❌ Sticker creation failed during processing. Details: {e}")
+        except Exception as e:
+            logger.error(f"Unhandled error while processing sticker: {e}", exc_info=True)
+            notify(job, f"❌ An unexpected error occurred during finalization. Details: {e}")
+        finally:
+            process_q.task_done()
+
+async def upload_worker():
+    """Stage 2: add the finished sticker to the shared pack."""
+    while True:
+        job = await upload_q.get()
+        try:
+            sticker = InputSticker(
+                sticker=BufferedInputFile(job.webp, filename="sticker.webp"),
+                emoji_list=["⭐"],
+                format="static",
+            )
+            # Attempt to add sticker
+            if not await pack_exists(PACK_NAME):
+                await create_pack(PACK_NAME, sticker)
+                final_text = f"✅ Sticker pack created! Your {job.mode} sticker has been added.\nAdd it here: {PACK_LINK}"
+            else:
+                await add_to_pack(PACK_NAME, sticker)
+                final_text = f"✅ {job.mode} sticker added to the shared pack!\nSee: {PACK_LINK}"
+        except TelegramBadRequest as e:
+            final_text = f"❌ Telegram API Error: Failed to add sticker. (Details: {e})"
+        except Exception as e:
+            logger.error(f"Unhandled error while uploading sticker: {e}", exc_info=True)
+            final_text = f"❌ An unexpected error occurred during finalization. Details: {e}"
+        notify(job, final_text)
+        upload_q.task_done()
+
+def start_pipeline() -> list[asyncio.Task]:
+    """Spawn the pipeline's worker tasks."""
+    workers = [asyncio.create_task(process_worker()) for _ in range(PPE_WORKERS)]
+    workers.append(asyncio.create_task(upload_worker()))
+    return workers
+
 # -------------------------
 # Handlers
 # -------------------------
 
 @dp.message(CommandStart())
 async def start_handler(message: types.Message):
-    pack_link = f"https://t.me/addstickers/{PACK_NAME}"
-    await message.answer(
+    # Replies go through 'bot' explicitly: message.answer() would use the polling session
+    await send_text(
+        message.chat.id,
         "👋 Welcome! Send me a photo (JPG, PNG) and I will prepare it for our shared sticker pack.\n\n"
         "I will automatically remove the background and then ask you how you want the sticker scaled!\n"
-        f"➡️ **Shared Sticker Pack Link:** {pack_link}"
+        f"➡️ **Shared Sticker Pack Link:** {PACK_LINK}"
     )
 
 @dp.message(F.photo)
 async def handle_photo_start(message: types.Message, state: FSMContext):
-    """Step 1: Receive photo, download, and ask for scaling mode."""
-    # Acknowledge receipt
-    wait_message = await message.answer("Photo received. Downloading and running background removal...")
-    
+    """Step 1: Receive photo and ask for scaling mode."""
     try:
-        # Take the highest quality photo
-        file_id = message.photo[-1].file_id
-        
-        # Download the file content into a BytesIO object
-        file_data = await bot.download(file_id, destination=BytesIO())
-        photo_bytes = file_data.read()
+        # Take the smallest photo size that still covers a 512x512 sticker
+        photo = pick_photo_size(message.photo)
         
-        # Store file data (as bytes) and the wait message ID in the state
-        await state.update_data(
-            photo_bytes=photo_bytes,
-            wait_message_id=wait_message.message_id
-        )
-        await state.set_state(StickerCreation.waiting_for_mode_selection)
+        # Download it while the user chooses a mode; the state only keeps the blob key,
+        # the file_id (fallback) and the wait message ID, never the image bytes.
+        # A newer photo replaces any earlier one still waiting for a mode.
+        drop_photo((await state.get_data()).get('blob_key'))
+        blob_key = f"{message.chat.id}:{message.message_id}"
+        prefetch_photo(blob_key, photo.file_id)
 
         # Build inline keyboard for scaling options
         builder = InlineKeyboardBuilder()
@@ -187,89 +609,93 @@ async def handle_photo_start(message: types.Message, state: FSMContext):
             types.InlineKeyboardButton(text="⏹️ Square Crop (Better for Pack)", callback_data="mode_square"),
         )
         
-        await bot.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=wait_message.message_id,
-            text="✅ Background removed! Please choose the final scaling mode for your sticker (512x512 max):",
+        # Acknowledge receipt and ask for the mode in one message; it is edited
+        # with the final result later instead of sending new ones.
+        wait_message = await send_text(
+            message.chat.id,
+            "✅ Photo received! Please choose the final scaling mode for your sticker (512x512 max):",
             reply_markup=builder.as_markup()
         )
+        await state.update_data(
+            blob_key=blob_key,
+            file_id=photo.file_id,
+            wait_message_id=wait_message.message_id
+        )
+        await state.set_state(StickerCreation.waiting_for_mode_selection)
 
     except Exception as e:
         logger.error(f"Error in handle_photo_start: {e}", exc_info=True)
-        await bot.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=wait_message.message_id,
-            text=f"❌ Failed to process photo for scaling. Details: {e}"
-        )
+        await send_text(message.chat.id, f"❌ Failed to process photo for scaling. Details: {e}")
         await state.clear()
 
 
 @dp.callback_query(StickerCreation.waiting_for_mode_selection, F.data.startswith("mode_"))
 async def handle_mode_selection(callback_query: types.CallbackQuery, state: FSMContext):
-    """Step 2: Process scaling mode and finalize sticker creation."""
-    await callback_query.answer("Processing your choice...")
+    """Step 2: Take the scaling mode and queue the sticker for processing."""
+    await call_limited(lambda: bot.answer_callback_query(callback_query.id, text="Processing your choice..."))
     
     data = await state.get_data()
-    photo_bytes = data.get('photo_bytes')
+    file_id = data.get('file_id')
     wait_message_id = data.get('wait_message_id')
     mode = callback_query.data.split('_')[1] # 'fit' or 'square'
     
-    if not photo_bytes:
-        await bot.edit_message_text(
-            chat_id=callback_query.message.chat.id,
+    if not file_id:
+        await edit_text(
+            callback_query.message.chat.id,
             message_id=wait_message_id,
             text="❌ Error: Original image data not found. Please resend the photo."
         )
         await state.clear()
         return
         
-    try:
-        # Re-run processing with the chosen mode
-        # We use the raw bytes from the state, preventing a second download.
-        sticker_file = resize_to_sticker(photo_bytes, mode)
-        pack_link = f"https://t.me/addstickers/{PACK_NAME}"
-        
-        # Attempt to add sticker
-        if not await pack_exists(PACK_NAME):
-            await create_pack(PACK_NAME, sticker_file)
-            final_text = f"✅ Sticker pack created! Your {mode} sticker has been added.\nAdd it here: {pack_link}"
-        else:
-            await add_to_pack(PACK_NAME, sticker_file)
-            final_text = f"✅ {mode} sticker added to the shared pack!\nSee: {pack_link}"
-            
-        await bot.edit_message_text(
-            chat_id=callback_query.message.chat.id,
-            message_id=wait_message_id,
-            text=final_text
-        )
-        
-    except ValueError as e:
-        final_text = f"❌ Sticker creation failed during processing. Details: {e}"
-    except TelegramBadRequest as e:
-        final_text = f"❌ Telegram API Error: Failed to add sticker. (Details: {e})"
-    except Exception as e:
-        logger.error(f"Unhandled error in handle_mode_selection: {e}", exc_info=True)
-        final_text = f"❌ An unexpected error occurred during finalization. Details: {e}"
-        
-    await bot.edit_message_text(
+    await state.clear() # The job carries everything the pipeline needs
+
+    # Waits here if the pipeline is backed up
+    await process_q.put(StickerJob(
         chat_id=callback_query.message.chat.id,
-        message_id=wait_message_id,
-        text=final_text
-    )
-    await state.clear() # Clear state after successful completion or error
+        wait_message_id=wait_message_id,
+        blob_key=data.get('blob_key'),
+        file_id=file_id,
+        mode=mode,
+    ))
 
-# Catch messages that are not photos (when state is clear)
-@dp.message()
+# Nudge plain text messages towards sending a photo; the filter keeps stickers,
+# service messages and commands from reaching the handler at all.
+@dp.message(F.text & ~F.text.startswith('/'))
 async def handle_other_messages(message: types.Message):
-    if not message.text or message.text.startswith('/'):
-        return # Ignore system messages or commands
-    await message.answer("Please send a photo (JPG or PNG) to start the sticker creation process.")
+    await send_text(message.chat.id, "Please send a photo (JPG or PNG) to start the sticker creation process.")
 
 
 # -------------------------
 # Run bot
 # -------------------------
 
+async def run_webhook():
+    """Register the webhook and serve Telegram's update POSTs until cancelled."""
+    # Telegram fans updates out over up to max_connections parallel requests
+    await bot.set_webhook(
+        url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        max_connections=100,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=True,
+        secret_token=WEBHOOK_SECRET,
+    )
+
+    app = web.Application()
+    # handle_in_background (the default) answers 200 right away and
+    # processes each update in its own task.
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logger.info(f"Webhook server listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     if not TOKEN:
         logger.error("BOT_TOKEN environment variable is not set. Exiting.")
@@ -277,20 +703,43 @@ async def main():
     if not OWNER_ID:
         logger.warning("OWNER_USER_ID is not set. Sticker creation will likely fail.")
         
+    background_tasks = []
     try:
         # 1. Initialize Bot Info (Cached operation)
         await init_bot_info()
-        logger.info("Bot info retrieved successfully. Starting polling...")
+        await start_pool()
+        background_tasks = [asyncio.create_task(expire_blobs()), *start_pipeline()]
         
-        # 2. Start Polling
-        # Includes a timeout for resilience against network issues
-        await dp.start_polling(bot, timeout=60)
+        # 2. Receive updates via webhook if configured, otherwise fall back to polling
+        if WEBHOOK_URL:
+            logger.info("Bot info retrieved successfully. Starting webhook...")
+            await run_webhook()
+        else:
+            logger.info("Bot info retrieved successfully. Starting polling...")
+            # getUpdates is refused (409 Conflict) while a webhook from an earlier
+            # webhook-mode run is still registered
+            await polling_bot.delete_webhook()
+            # aiogram reconnects with backoff on its own; polling_timeout is the
+            # long-poll wait, and allowed_updates limits getUpdates to types we handle
+            await dp.start_polling(
+                polling_bot,
+                polling_timeout=60,
+                handle_signals=True,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
         
     except Exception as e:
         logger.critical(f"Bot failed to start: {e}", exc_info=True)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await bot.session.close()
+        if PPE:
+            PPE.shutdown(cancel_futures=True)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
         logger.info("Bot stopped by user.")
\ No newline at end of file